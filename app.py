@@ -4,48 +4,153 @@ Koatsume - Connect lots of little things together
 A cross-platform application using PyWebView with Material UI interface
 """
 
-import json
+import copy
+import functools
+import ipaddress
+import logging
 import os
+import socket
 import threading
 import time
 from pathlib import Path
 
+import orjson
 import webview
 from zeroconf import ServiceBrowser, ServiceInfo, Zeroconf
 
+logger = logging.getLogger(__name__)
+
+
+# Parsed config files keyed by path, stored with the mtime they were read at
+_CONFIG_CACHE = {}
+
+
+@functools.lru_cache(maxsize=1)
+def _get_hostname():
+    """Get this machine's hostname, cached for the lifetime of the process"""
+    return socket.gethostname()
+
+
+def _get_routed_ip():
+    """Ask the routing table which local address would be used for outbound traffic"""
+    # Connecting a UDP socket sends nothing, it only selects a route
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        s.connect(('8.8.8.8', 80))
+        return s.getsockname()[0]
+    finally:
+        s.close()
+
+
+@functools.lru_cache(maxsize=1)
+def _get_local_ip():
+    """Get the local IP address to advertise, cached once a lookup succeeds"""
+    # Failures raise OSError (e.g. before the network is up), which lru_cache does not cache
+    # Collect the addresses the hostname resolves to, skipping loopback and link-local ones
+    candidates = []
+    try:
+        for *_, sockaddr in socket.getaddrinfo(_get_hostname(), None, socket.AF_INET):
+            address = ipaddress.ip_address(sockaddr[0])
+            if not (address.is_loopback or address.is_link_local) and str(address) not in candidates:
+                candidates.append(str(address))
+    except OSError:
+        pass
+    
+    # A single LAN address is unambiguous, so no socket is needed
+    if len(candidates) == 1:
+        return candidates[0]
+    
+    # Machines with Hyper-V, WSL or VPN adapters list every adapter's address in no
+    # particular order, so let the routing table pick the one peers can actually reach
+    try:
+        return _get_routed_ip()
+    except OSError:
+        if candidates:
+            return candidates[0]
+        raise
+
+
+# Packed address bytes mapped to their printable form, oldest entries evicted first
+_ADDR_CACHE = {}
+_ADDR_CACHE_SIZE = 256
+
+
+def _addr_to_str(addr):
+    """Convert a packed IPv4/IPv6 address to a human-readable string"""
+    text = _ADDR_CACHE.get(addr)
+    if text is None:
+        try:
+            text = socket.inet_ntop(socket.AF_INET if len(addr) == 4 else socket.AF_INET6, addr)
+        except Exception:
+            text = addr.hex()
+        if len(_ADDR_CACHE) >= _ADDR_CACHE_SIZE:
+            del _ADDR_CACHE[next(iter(_ADDR_CACHE))]
+        _ADDR_CACHE[addr] = text
+    return text
+
 
 class KoatsumeApp:
     """Main application class for Koatsume"""
     
     def __init__(self):
         self.config_file = Path("config.json")
+        self._last_serialized = None
         self.config = self.load_config()
-        self.discovered_instances = []
+        self.discovered_instances = {}  # Keyed by service name
         self.hidden_instances = set()  # Track instances hidden by user
+        self.instances_lock = threading.Lock()  # Guards mutation of the two collections above
         self.zeroconf = None
         self.browser = None
         self.service_info = None
+        self.service_addresses = None  # Packed addresses advertised by our service
         self.window = None
-        self.heartbeat_thread = None
-        self.running = True
+        self.ui_thread = None
+        self._ui_dirty = threading.Event()  # Set when the UI needs to refresh instances
+        self._ui_refresh = False  # Whether the instance list itself changed, guarded by instances_lock
+        self._pending_last_seen = {}  # Timestamp-only refreshes not yet pushed, guarded by instances_lock
+        self._stop_event = threading.Event()  # Set once the app is shutting down
         
     def load_config(self):
-        """Load configuration from JSON file"""
-        if self.config_file.exists():
+        """Load configuration from JSON file, reusing the cached parse if unchanged"""
+        try:
+            mtime = self.config_file.stat().st_mtime
+        except OSError:
+            return {"username": ""}
+        
+        cached = _CONFIG_CACHE.get(self.config_file)
+        if cached and cached[0] == mtime:
+            config = copy.deepcopy(cached[1])
+        else:
             try:
-                with open(self.config_file, 'r') as f:
-                    return json.load(f)
+                with open(self.config_file, 'rb') as f:
+                    config = orjson.loads(f.read())
             except Exception as e:
-                print(f"Error loading config: {e}")
-        return {"username": ""}
+                logger.error("Error loading config: %s", e)
+                return {"username": ""}
+            _CONFIG_CACHE[self.config_file] = (mtime, copy.deepcopy(config))
+        
+        self._last_serialized = orjson.dumps(config, option=orjson.OPT_SORT_KEYS)
+        return config
     
     def save_config(self):
-        """Save configuration to JSON file"""
+        """Save configuration to JSON file, skipping the write if nothing changed"""
+        serialized = orjson.dumps(self.config, option=orjson.OPT_SORT_KEYS)
+        if serialized == self._last_serialized:
+            return
+        
+        # Write to a temporary file and swap it in so a crash never leaves a partial config
+        tmp_file = self.config_file.with_name(self.config_file.name + ".tmp")
         try:
-            with open(self.config_file, 'w') as f:
-                json.dump(self.config, f, indent=2)
+            with open(tmp_file, 'wb') as f:
+                f.write(orjson.dumps(self.config, option=orjson.OPT_INDENT_2))
+            os.replace(tmp_file, self.config_file)
+            mtime = self.config_file.stat().st_mtime
         except Exception as e:
-            print(f"Error saving config: {e}")
+            logger.error("Error saving config: %s", e)
+            return
+        
+        _CONFIG_CACHE[self.config_file] = (mtime, copy.deepcopy(self.config))
+        self._last_serialized = serialized
     
     def get_username(self):
         """Get the current username"""
@@ -60,90 +165,106 @@ class KoatsumeApp:
     
     def get_discovered_instances(self):
         """Get list of discovered instances"""
-        current_time = time.time()
-        result = []
-        for instance in self.discovered_instances:
-            # Skip hidden instances
-            if instance["name"] in self.hidden_instances:
-                continue
-            
-            # Calculate if instance is connected (seen within last 1 second)
-            time_since_seen = current_time - instance["last_seen"]
-            instance_copy = instance.copy()
-            instance_copy["connected"] = time_since_seen <= 1.0
-            instance_copy["time_since_seen"] = time_since_seen
-            result.append(instance_copy)
-        
-        return result
+        # Snapshot under the lock since the zeroconf thread mutates both collections
+        with self.instances_lock:
+            instances = list(self.discovered_instances.values())
+            hidden = frozenset(self.hidden_instances)
+        
+        # Only ship the fields the UI renders; connection status is derived from last_seen there
+        return [
+            {
+                "name": instance["name"],
+                "display_name": instance["display_name"],
+                "username": instance["username"],
+                "server": instance["server"],
+                "last_seen": instance["last_seen"],
+            }
+            for instance in instances
+            if instance["name"] not in hidden  # Skip hidden instances
+        ]
     
     def hide_instance(self, name):
         """Hide an instance from the view"""
-        self.hidden_instances.add(name)
-        # Update UI if window exists
-        if self.window:
-            self.window.evaluate_js('updateInstances()')
+        with self.instances_lock:
+            self.hidden_instances.add(name)
+            self._ui_refresh = True
+        # Let the UI thread push the change
+        self._ui_dirty.set()
         return {"status": "success"}
     
     def add_discovered_instance(self, info):
         """Add a discovered instance to the list"""
-        import socket
+        signature = hash((
+            info.name,
+            info.server,
+            tuple(info.addresses),
+            info.port,
+            tuple(sorted((info.properties or {}).items())),
+        ))
+        current_time = time.time()
+        
+        with self.instances_lock:
+            existing = self.discovered_instances.get(info.name)
+            # An identical record is just a TTL refresh, so only the timestamp moves
+            if existing and existing["_sig"] == signature and info.name not in self.hidden_instances:
+                existing["last_seen"] = current_time
+                self._pending_last_seen[info.name] = current_time
+                self._ui_dirty.set()
+                return
         
         # Convert addresses to human-readable format
-        addresses = []
-        for addr in info.addresses:
-            try:
-                if len(addr) == 4:  # IPv4
-                    addresses.append(socket.inet_ntoa(addr))
-                elif len(addr) == 16:  # IPv6
-                    addresses.append(socket.inet_ntop(socket.AF_INET6, addr))
-            except Exception:
-                addresses.append(addr.hex())
+        addresses = [_addr_to_str(addr) for addr in info.addresses]
+        
+        properties = {k.decode(): v.decode() for k, v in info.properties.items()} if info.properties else {}
         
-        current_time = time.time()
         instance = {
             "name": info.name,
+            "display_name": info.name.split('.')[0],
+            "username": properties.get("username") or "Unknown",
             "server": info.server,
             "addresses": addresses,
             "port": info.port,
-            "properties": {k.decode(): v.decode() for k, v in info.properties.items()} if info.properties else {},
+            "properties": properties,
             "last_seen": current_time,
-            "connected": True
-        }
-        
-        # Check if already exists
-        for i, existing in enumerate(self.discovered_instances):
-            if existing["name"] == instance["name"]:
-                # Update existing instance with fresh timestamp
-                instance["last_seen"] = current_time
-                instance["connected"] = True
-                self.discovered_instances[i] = instance
-                # Remove from hidden list if it reappears
-                self.hidden_instances.discard(instance["name"])
-                return
+            "_sig": signature
+        }
         
-        self.discovered_instances.append(instance)
-        # Remove from hidden list if it reappears
-        self.hidden_instances.discard(instance["name"])
+        with self.instances_lock:
+            self.discovered_instances[instance["name"]] = instance
+            # Remove from hidden list if it reappears
+            self.hidden_instances.discard(instance["name"])
+            self._ui_refresh = True
         
-        # Update UI if window exists
-        if self.window:
-            self.window.evaluate_js('updateInstances()')
+        # Let the UI thread push the change
+        self._ui_dirty.set()
     
     def remove_discovered_instance(self, name):
         """Remove a discovered instance from the list"""
-        self.discovered_instances = [i for i in self.discovered_instances if i["name"] != name]
+        with self.instances_lock:
+            self.discovered_instances.pop(name, None)
+            self._ui_refresh = True
         
-        # Update UI if window exists
-        if self.window:
-            self.window.evaluate_js('updateInstances()')
+        # Let the UI thread push the change
+        self._ui_dirty.set()
     
-    def check_heartbeat(self):
-        """Periodically check instance heartbeats"""
-        while self.running:
-            time.sleep(0.5)  # Check every 500ms to match UI update frequency
+    def push_ui_updates(self):
+        """Push instance changes to the UI whenever the instance set changes"""
+        while self._ui_dirty.wait() and not self._stop_event.is_set():
+            # Coalesce bursts of discovery events into a single push, but exit immediately on shutdown
+            if self._stop_event.wait(0.5):
+                break
+            self._ui_dirty.clear()
+            with self.instances_lock:
+                refresh, self._ui_refresh = self._ui_refresh, False
+                last_seen, self._pending_last_seen = self._pending_last_seen, {}
+            
             if self.window:
                 try:
-                    self.window.evaluate_js('updateInstances()')
+                    if refresh:
+                        self.window.evaluate_js('updateInstances()')
+                    elif last_seen:
+                        # Nothing but timestamps changed, so skip refetching the whole list
+                        self.window.evaluate_js(f'touchInstances({orjson.dumps(last_seen).decode()})')
                 except Exception:
                     pass
     
@@ -158,43 +279,41 @@ class KoatsumeApp:
         listener = ServiceListener(self)
         self.browser = ServiceBrowser(self.zeroconf, "_koatsume._tcp.local.", listener)
         
-        # Start heartbeat checking thread
-        self.heartbeat_thread = threading.Thread(target=self.check_heartbeat, daemon=True)
-        self.heartbeat_thread.start()
+        # Start the thread that pushes instance changes to the UI
+        self.ui_thread = threading.Thread(target=self.push_ui_updates, daemon=True)
+        self.ui_thread.start()
     
-    def register_service(self):
-        """Register this instance as a zeroconf service"""
-        import socket
-        
-        hostname = socket.gethostname()
+    def build_service_info(self):
+        """Build the zeroconf service info describing this instance"""
+        hostname = _get_hostname()
         username = self.config.get("username", "Anonymous")
         
         # Create service info
         service_name = f"koatsume-{hostname}._koatsume._tcp.local."
         
-        # Get local IP address
-        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        try:
-            s.connect(('8.8.8.8', 80))
-            local_ip = s.getsockname()[0]
-        except Exception:
-            local_ip = '127.0.0.1'
-        finally:
-            s.close()
-        
-        # Parse IP address - handle both IPv4 and IPv6
-        try:
-            # Try IPv4 first
-            if ':' not in local_ip:
-                addresses = [socket.inet_aton(local_ip)]
-            else:
-                # IPv6
-                addresses = [socket.inet_pton(socket.AF_INET6, local_ip)]
-        except Exception as e:
-            print(f"Error parsing IP address {local_ip}: {e}")
+        # Parse the local IP address once - handle both IPv4 and IPv6
+        addresses = self.service_addresses
+        if addresses is None:
+            # Advertise loopback until a real address is found, without caching it,
+            # so the next update_service tries the lookup again
             addresses = [socket.inet_aton('127.0.0.1')]
-        
-        self.service_info = ServiceInfo(
+            try:
+                local_ip = _get_local_ip()
+            except OSError as e:
+                logger.error("Error determining local IP address: %s", e)
+            else:
+                try:
+                    # Try IPv4 first
+                    if ':' not in local_ip:
+                        addresses = [socket.inet_aton(local_ip)]
+                    else:
+                        # IPv6
+                        addresses = [socket.inet_pton(socket.AF_INET6, local_ip)]
+                    self.service_addresses = addresses
+                except Exception as e:
+                    logger.error("Error parsing IP address %s: %s", local_ip, e)
+        
+        return ServiceInfo(
             "_koatsume._tcp.local.",
             service_name,
             addresses=addresses,
@@ -202,25 +321,52 @@ class KoatsumeApp:
             properties={b"username": username.encode()},
             server=f"{hostname}.local."
         )
+    
+    def register_service(self):
+        """Register this instance as a zeroconf service"""
+        self.service_info = self.build_service_info()
         
         try:
             self.zeroconf.register_service(self.service_info)
-            print(f"Registered service: {service_name}")
+            logger.info("Registered service: %s", self.service_info.name)
         except Exception as e:
-            print(f"Error registering service: {e}")
+            logger.error("Error registering service: %s", e)
     
     def update_service(self):
         """Update the zeroconf service when username changes"""
         if self.service_info and self.zeroconf:
+            service_info = self.build_service_info()
+            
+            # A username change only touches the TXT record, which can be updated in place
+            if (service_info.name == self.service_info.name
+                    and service_info.server == self.service_info.server
+                    and service_info.addresses == self.service_info.addresses):
+                try:
+                    self.zeroconf.update_service(service_info)
+                    self.service_info = service_info
+                    return
+                except Exception as e:
+                    logger.error("Error updating service: %s", e)
+            
+            # Hostname or address changed, so announce the service from scratch
             try:
                 self.zeroconf.unregister_service(self.service_info)
             except Exception:
                 pass
             self.register_service()
     
+    def refresh_network_info(self):
+        """Re-detect the hostname and local IP, e.g. after switching networks"""
+        _get_hostname.cache_clear()
+        _get_local_ip.cache_clear()
+        self.service_addresses = None
+        self.update_service()
+        return {"status": "success"}
+    
     def stop_zeroconf(self):
         """Stop zeroconf service"""
-        self.running = False
+        self._stop_event.set()
+        self._ui_dirty.set()  # Wake the UI thread so it can exit
         
         if self.service_info and self.zeroconf:
             try:
@@ -242,25 +388,24 @@ class ServiceListener:
         """Called when a service is discovered"""
         info = zeroconf.get_service_info(service_type, name)
         if info:
-            print(f"Service added: {name}")
+            logger.debug("Service added: %s", name)
             self.app.add_discovered_instance(info)
     
     def remove_service(self, zeroconf, service_type, name):
         """Called when a service is removed"""
-        print(f"Service removed: {name}")
+        logger.debug("Service removed: %s", name)
         self.app.remove_discovered_instance(name)
     
     def update_service(self, zeroconf, service_type, name):
         """Called when a service is updated"""
         info = zeroconf.get_service_info(service_type, name)
         if info:
-            print(f"Service updated: {name}")
+            logger.debug("Service updated: %s", name)
             self.app.add_discovered_instance(info)
 
 
-def get_html():
-    """Generate the HTML interface"""
-    return """
+# The HTML interface, built once at import time
+_HTML = """
 <!DOCTYPE html>
 <html>
 <head>
@@ -419,6 +564,10 @@ def get_html():
             opacity: 0.7;
         }
         
+        .instance-tile:not(.disconnected) .close-btn {
+            display: none;
+        }
+        
         .instance-tile.disconnected::before {
             content: '';
             position: absolute;
@@ -533,7 +682,7 @@ def get_html():
         <div class="instances-section">
             <h2>Discovered Instances</h2>
             <div id="instances" class="instances-grid">
-                <div class="empty-state">
+                <div id="empty-state" class="empty-state">
                     <div class="empty-state-icon">🔍</div>
                     <p>Looking for other Koatsume instances on your network...</p>
                 </div>
@@ -542,6 +691,19 @@ def get_html():
     </div>
     
     <script>
+        // Rendered tiles keyed by instance name, so updates only touch what changed
+        const tiles = new Map();
+        const emptyState = document.getElementById('empty-state');
+        
+        // One delegated listener handles the close buttons of every tile
+        document.getElementById('instances').addEventListener('click', (e) => {
+            const closeBtn = e.target.closest('.close-btn');
+            if (closeBtn) {
+                const tile = closeBtn.closest('.instance-tile');
+                hideInstance(tile.getAttribute('data-instance-name'));
+            }
+        });
+        
         // Load username on startup
         window.addEventListener('pywebviewready', async () => {
             try {
@@ -551,9 +713,9 @@ def get_html():
                 console.error('Error loading username:', e);
             }
             
-            // Start polling for instances
+            // Initial load; later changes to the instance set are pushed from Python
             updateInstances();
-            setInterval(updateInstances, 500);  // Update every 500ms for responsive disconnection detection
+            setInterval(recomputeStatuses, 500);  // Refresh statuses locally for responsive disconnection detection
         });
         
         async function saveUsername() {
@@ -590,10 +752,10 @@ def get_html():
             }
         }
         
+        const HTML_ESCAPES = {'&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;', "'": '&#39;'};
+        
         function escapeHtml(text) {
-            const div = document.createElement('div');
-            div.textContent = text;
-            return div.innerHTML;
+            return String(text).replace(/[&<>"']/g, c => HTML_ESCAPES[c]);
         }
         
         async function hideInstance(name) {
@@ -604,48 +766,88 @@ def get_html():
             }
         }
         
+        function setText(tile, selector, text) {
+            const element = tile.querySelector(selector);
+            if (element.textContent !== text) {
+                element.textContent = text;
+            }
+        }
+        
+        function updateTileStatus(tile) {
+            // Connected means seen within the last second
+            const timeSinceSeen = Date.now() / 1000 - parseFloat(tile.getAttribute('data-last-seen'));
+            const connected = timeSinceSeen <= 1.0;
+            tile.classList.toggle('disconnected', !connected);
+            setText(tile, '.instance-status', connected
+                ? '✅ Connected'
+                : `⏰ Last seen ${formatTimeSince(timeSinceSeen)}`);
+        }
+        
+        function recomputeStatuses() {
+            tiles.forEach(updateTileStatus);
+        }
+        
+        function createTile(instance) {
+            const tile = document.createElement('div');
+            tile.className = 'instance-tile';
+            tile.setAttribute('data-instance-name', instance.name);
+            tile.innerHTML = `
+                <div class="close-btn">✕</div>
+                <div class="instance-name">👤 ${escapeHtml(instance.username)}</div>
+                <div class="instance-info">📡 ${escapeHtml(instance.display_name)}</div>
+                <div class="instance-server">🖥️ ${escapeHtml(instance.server)}</div>
+                <div class="instance-status"></div>
+            `;
+            return tile;
+        }
+        
+        function touchInstances(lastSeen) {
+            // Apply fresh timestamps for instances whose details did not change
+            for (const [name, timestamp] of Object.entries(lastSeen)) {
+                const tile = tiles.get(name);
+                if (tile) {
+                    tile.setAttribute('data-last-seen', timestamp);
+                    updateTileStatus(tile);
+                }
+            }
+        }
+        
         async function updateInstances() {
             try {
                 const instances = await pywebview.api.get_discovered_instances();
                 const container = document.getElementById('instances');
+                const current = new Set();
+                
+                for (const instance of instances) {
+                    current.add(instance.name);
+                    let tile = tiles.get(instance.name);
+                    if (tile) {
+                        // Existing tile: only touch fields that actually changed
+                        setText(tile, '.instance-name', `👤 ${instance.username}`);
+                        setText(tile, '.instance-info', `📡 ${instance.display_name}`);
+                        setText(tile, '.instance-server', `🖥️ ${instance.server}`);
+                    } else {
+                        tile = createTile(instance);
+                        tiles.set(instance.name, tile);
+                        container.appendChild(tile);
+                    }
+                    tile.setAttribute('data-last-seen', instance.last_seen);
+                    updateTileStatus(tile);
+                }
+                
+                // Drop tiles for instances that went away or were hidden
+                for (const [name, tile] of tiles) {
+                    if (!current.has(name)) {
+                        tile.remove();
+                        tiles.delete(name);
+                    }
+                }
                 
-                if (instances.length === 0) {
-                    container.innerHTML = `
-                        <div class="empty-state">
-                            <div class="empty-state-icon">🔍</div>
-                            <p>Looking for other Koatsume instances on your network...</p>
-                        </div>
-                    `;
+                // Only show the empty state while there are no tiles
+                if (tiles.size === 0) {
+                    container.appendChild(emptyState);
                 } else {
-                    container.innerHTML = instances.map((instance, index) => {
-                        const username = escapeHtml(instance.properties?.username || 'Unknown');
-                        const disconnectedClass = instance.connected ? '' : 'disconnected';
-                        const statusText = instance.connected 
-                            ? '✅ Connected' 
-                            : `⏰ Last seen ${formatTimeSince(instance.time_since_seen)}`;
-                        const closeBtn = !instance.connected 
-                            ? `<div class="close-btn" data-instance-index="${index}">✕</div>`
-                            : '';
-                        
-                        return `
-                            <div class="instance-tile ${disconnectedClass}" data-instance-name="${escapeHtml(instance.name)}">
-                                ${closeBtn}
-                                <div class="instance-name">👤 ${username}</div>
-                                <div class="instance-info">📡 ${escapeHtml(instance.name.split('.')[0])}</div>
-                                <div class="instance-server">🖥️ ${escapeHtml(instance.server)}</div>
-                                <div class="instance-status">${statusText}</div>
-                            </div>
-                        `;
-                    }).join('');
-                    
-                    // Add event listeners for close buttons
-                    document.querySelectorAll('.close-btn').forEach(btn => {
-                        btn.addEventListener('click', (e) => {
-                            const tile = e.target.closest('.instance-tile');
-                            const instanceName = tile.getAttribute('data-instance-name');
-                            hideInstance(instanceName);
-                        });
-                    });
+                    emptyState.remove();
                 }
             } catch (e) {
                 console.error('Error updating instances:', e);
@@ -654,11 +856,18 @@ def get_html():
     </script>
 </body>
 </html>
-    """
+"""
+
+
+def get_html():
+    """Get the HTML interface"""
+    return _HTML
 
 
 def main():
     """Main entry point"""
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
+    
     app = KoatsumeApp()
     
     # Start zeroconf in a regular background thread for proper cleanup